@@ -1 +1,4 @@
+import time
+load_start = time.perf_counter()
+
 __all__ = ["main"]
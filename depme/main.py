@@ -1,7 +1,18 @@
-import argparse
+from __future__ import annotations
+
+import time
 import sys
+
+# started in depme/__init__.py so loading (and compiling) this module is counted
+timings = {"start": getattr(sys.modules.get("depme"), "load_start", time.perf_counter())}
 from collections import defaultdict
-from pathlib import Path
+
+# heavier modules (argparse, subprocess, pathlib, concurrent.futures, ...) are
+# imported where they are used, depme runs in every job prologue so startup counts
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    import subprocess
+    from pathlib import Path
 
 ##############
 #### Tools ###
@@ -69,16 +80,7 @@ class colors:
 ### Functions ###
 #################
 import os
-import sys
-import subprocess
-from pathlib import Path
-from textwrap import dedent, indent
-
-try:
-    from signal import SIGKILL
-except ImportError:
-    # A non-POSIX platform
-    SIGKILL = None
+from functools import lru_cache
 
 def run_shell_command(cmd, raise_errors=True, extra_env=None): # print_error=False
     """
@@ -103,6 +105,7 @@ class ShellCommandRunner:
         self.extra_env = extra_env
 
     def run(self):
+        import subprocess
         try:
             self.invoke_command()
         except subprocess.CalledProcessError as error:
@@ -115,6 +118,7 @@ class ShellCommandRunner:
         return True
 
     def invoke_command(self):
+        import subprocess
         return subprocess.check_output(
             self.shell_executable + self.shell_args,
             shell=False,
@@ -143,20 +147,27 @@ class ShellCommandRunner:
 
         return env
 
-def check_exe(tool: str) -> bool:
+def tool_call(tool: str) -> list:
     """
-    Test if tool exists.
+    Look up the tools_lib command for a tool, dropping any version.
 
-    Return True if exists, else False
+    Return the command or None if the tool is not in tools_lib
     """
     # drop version
     if "=" in tool:
         pos = tool.index("=") 
         tool = tool[:pos] 
 
-    try:
-        call = tools_lib[tool]
-    except KeyError as e:
+    return(tools_lib.get(tool))
+
+def check_exe(tool: str) -> bool:
+    """
+    Test if tool exists.
+
+    Return True if exists, else False
+    """
+    call = tool_call(tool)
+    if call is None:
         return "Not tested"
     try:
         run_shell_command(" ".join(call))
@@ -199,6 +210,7 @@ def check_r(r_packages: list) -> list[bool]:
         "\"| R --slave"
     ]
     # output is bytes of bool eg b'FALSE TRUE FALSE'
+    import subprocess
     call_output = subprocess.check_output(" ".join(call), shell=True).decode("utf-8")
     
     bool_of_packages = []
@@ -210,6 +222,362 @@ def check_r(r_packages: list) -> list[bool]:
 
     return(bool_of_packages)
 
+ld_cache_path = "/etc/ld.so.cache"
+
+@lru_cache(maxsize=None)
+def read_ld_cache(path: str = ld_cache_path) -> dict:
+    '''
+    Parse the ld.so cache (glibc-ld.so.cache1.1 format), memory-mapped and read once.
+    Returns {library name: [paths]}, empty if the cache can't be read.
+    '''
+    import mmap
+    import struct
+    libraries = defaultdict(list)
+    try:
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as cache:
+            # may be preceded by the old ld.so-1.7.0 format, offsets are relative to this header
+            start = cache.find(b"glibc-ld.so.cache1.1")
+            if start == -1:
+                return(libraries)
+            nlibs, = struct.unpack_from("<I", cache, start + 20)
+            for i in range(nlibs):
+                flags, key, value = struct.unpack_from("<iII", cache, start + 48 + i * 24)
+                name = cache[start + key:cache.find(b"\0", start + key)].decode()
+                libraries[name].append(cache[start + value:cache.find(b"\0", start + value)].decode())
+    except (OSError, ValueError, struct.error):
+        pass
+    return(libraries)
+
+@lru_cache(maxsize=None)
+def elf_ident(path: str) -> tuple:
+    '''
+    Return (class, byte order, machine) of an ELF file or None if not ELF
+    '''
+    import struct
+    try:
+        with open(path, "rb") as file:
+            header = file.read(20)
+    except OSError:
+        return None
+    if len(header) < 20 or header[:4] != b"\x7fELF":
+        return None
+    order = "<" if header[5] == 1 else ">"
+    machine, = struct.unpack_from(order + "H", header, 18)
+    return(header[4], order, machine)
+
+def read_elf(path: str) -> dict:
+    '''
+    Read the dynamic section of an ELF file.
+    Returns dict with needed, rpath and runpath lists, or None if not a (dynamic) ELF file.
+    A truncated or corrupt file raises struct.error or ValueError.
+    '''
+    import mmap
+    import struct
+    ident = elf_ident(path)
+    if not ident:
+        return None
+    elf_class, order, _ = ident
+    if elf_class == 2:
+        header_fmt, phdr_fmt, dyn_fmt = "HHIQQQIHHH", "IIQQQQQQ", "qQ"
+    else:
+        header_fmt, phdr_fmt, dyn_fmt = "HHIIIIIHHH", "IIIIIIII", "iI"
+
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as elf:
+        header = struct.unpack_from(order + header_fmt, elf, 16)
+        phoff, phentsize, phnum = header[4], header[8], header[9]
+
+        loads = []
+        dynamic = None
+        for i in range(phnum):
+            phdr = struct.unpack_from(order + phdr_fmt, elf, phoff + i * phentsize)
+            if elf_class == 2:
+                p_type, p_offset, p_vaddr, p_filesz = phdr[0], phdr[2], phdr[3], phdr[5]
+            else:
+                p_type, p_offset, p_vaddr, p_filesz = phdr[0], phdr[1], phdr[2], phdr[4]
+            if p_type == 1: # PT_LOAD
+                loads.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == 2: # PT_DYNAMIC
+                dynamic = (p_offset, p_filesz)
+        if dynamic is None:
+            return({"needed": [], "rpath": [], "runpath": []})
+
+        entries = []
+        strtab = None
+        dyn_size = struct.calcsize(order + dyn_fmt)
+        for offset in range(dynamic[0], dynamic[0] + dynamic[1], dyn_size):
+            tag, value = struct.unpack_from(order + dyn_fmt, elf, offset)
+            if tag == 0: # DT_NULL
+                break
+            elif tag == 5: # DT_STRTAB
+                strtab = value
+            elif tag in (1, 15, 29): # DT_NEEDED, DT_RPATH, DT_RUNPATH
+                entries.append((tag, value))
+
+        # DT_STRTAB is a virtual address, map it back to a file offset
+        strtab_offset = None
+        for p_vaddr, p_offset, p_filesz in loads:
+            if strtab is not None and p_vaddr <= strtab < p_vaddr + p_filesz:
+                strtab_offset = strtab - p_vaddr + p_offset
+                break
+        if entries and strtab_offset is None:
+            raise ValueError("no mapped DT_STRTAB")
+
+        dyn = {1: [], 15: [], 29: []}
+        for tag, value in entries:
+            start = strtab_offset + value
+            end = elf.find(b"\0", start)
+            if end == -1:
+                raise ValueError("dynamic string outside file")
+            dyn[tag].append(elf[start:end].decode())
+
+    return({"needed": dyn[1],
+            "rpath": [d for path in dyn[15] for d in path.split(":")],
+            "runpath": [d for path in dyn[29] for d in path.split(":")]})
+
+def expand_origin(dirs: list, origin: str, elf_class: int) -> list:
+    lib = "lib64" if elf_class == 2 else "lib"
+    return([d.replace("${ORIGIN}", origin).replace("$ORIGIN", origin)
+             .replace("${LIB}", lib).replace("$LIB", lib) for d in dirs if d])
+
+def find_lib(name: str, dirs: list, ident: tuple) -> str:
+    '''
+    Resolve a DT_NEEDED library the way ld.so does: search dirs, then the ld.so cache,
+    then the default directories. Only libraries matching ident (see elf_ident) are accepted.
+    Returns the path or None.
+    '''
+    if "/" in name:
+        return(name if elf_ident(name) == ident else None)
+
+    defaults = ["/lib64", "/usr/lib64", "/lib", "/usr/lib"] if ident[0] == 2 else ["/lib", "/usr/lib"]
+    candidates = [os.path.join(d, name) for d in dirs]
+    candidates += read_ld_cache().get(name, [])
+    candidates += [os.path.join(d, name) for d in defaults]
+    for candidate in candidates:
+        if elf_ident(candidate) == ident:
+            return(candidate)
+    return None
+
+def missing_libs(path: str) -> list:
+    '''
+    Resolve DT_NEEDED libraries of an ELF file, and of those libraries in turn,
+    against RPATH/RUNPATH, LD_LIBRARY_PATH and the ld.so cache. Nothing is executed.
+
+    Returns names of the libraries that could not be found.
+    '''
+    ident = elf_ident(path)
+    if not ident:
+        return([])
+    ld_library_path = [d for d in os.environ.get("LD_LIBRARY_PATH", "").split(":") if d]
+
+    missing = []
+    seen = {os.path.realpath(path)}
+    # (object, RPATH inherited from the objects that loaded it)
+    queue = [(path, [])]
+    while queue:
+        obj, inherited = queue.pop(0)
+        dynamic = read_elf(obj)
+        if not dynamic:
+            continue
+        origin = os.path.dirname(os.path.realpath(obj))
+        runpath = expand_origin(dynamic["runpath"], origin, ident[0])
+        # RPATH is ignored when RUNPATH is set
+        rpath = [] if runpath else expand_origin(dynamic["rpath"], origin, ident[0]) + inherited
+        for name in dynamic["needed"]:
+            lib = find_lib(name, rpath + ld_library_path + runpath, ident)
+            if lib is None:
+                if name not in missing:
+                    missing.append(name)
+            elif os.path.realpath(lib) not in seen:
+                seen.add(os.path.realpath(lib))
+                queue.append((lib, rpath))
+    return(missing)
+
+def resolve_exe(exe: str) -> tuple:
+    '''
+    Find exe on PATH, following #! scripts to their interpreter (including env).
+    Returns (path, missing interpreter): path is None if exe is not on PATH,
+    missing interpreter is the #! interpreter that can't be found (or None).
+    '''
+    import shutil
+    path = shutil.which(exe)
+    if path is None:
+        return(None, None)
+    try:
+        with open(path, "rb") as file:
+            first_line = file.readline(256)
+    except OSError:
+        return(path, None)
+    if not first_line.startswith(b"#!"):
+        return(path, None)
+    shebang = first_line[2:].decode(errors="ignore").split()
+    if not shebang:
+        return(path, None)
+    if os.path.basename(shebang[0]) == "env" and len(shebang) > 1:
+        interpreter = [arg for arg in shebang[1:] if not arg.startswith("-")]
+        if not interpreter:
+            return(path, None)
+        found = shutil.which(interpreter[0])
+        return((found, None) if found else (path, interpreter[0]))
+    return((shebang[0], None) if os.path.exists(shebang[0]) else (path, shebang[0]))
+
+def check_libs(tool: str) -> str:
+    """
+    Test if tool exists and its shared libraries can be loaded,
+    without running it.
+
+    Return Installed, Missing, Broken (missing libfoo.so)
+    or Broken (missing interpreter /path/to/python)
+    """
+    call = tool_call(tool)
+    if call is None:
+        return "Not tested"
+    import struct
+    path, missing_interpreter = resolve_exe(call[0])
+    if path is None:
+        return "Missing"
+    if missing_interpreter:
+        return f"Broken (missing interpreter {missing_interpreter})"
+    try:
+        missing = missing_libs(path)
+    except (struct.error, ValueError, OSError) as e:
+        return f"Broken (unreadable ELF: {e})"
+    if missing:
+        return f"Broken (missing {', '.join(missing)})"
+    return "Installed"
+
+def kill_probe(proc: subprocess.Popen) -> None:
+    """
+    Kill a running probe and anything it spawned.
+    """
+    try:
+        from signal import SIGKILL
+    except ImportError:
+        # A non-POSIX platform
+        SIGKILL = None
+
+    if proc.poll() is not None:
+        return
+    if SIGKILL is not None:
+        try:
+            os.killpg(proc.pid, SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        proc.kill()
+
+def run_probes(probes: dict, results: dict, threads: int = 4) -> str:
+    '''
+    Run tools_lib commands concurrently, one bash process per dep and at most
+    threads at a time. Status codes follow ShellCommandRunner: 0 or 1 is Installed,
+    anything else is Missing.
+    As soon as one probe reports Missing (or fails to start) the running probes
+    are killed and queued ones are never started.
+
+    Fills results in place, returns the first missing dep or None.
+    '''
+    import subprocess
+    import threading
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    if not probes:
+        return None
+
+    procs = []
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def probe(call):
+        runner = ShellCommandRunner(" ".join(call))
+        with lock:
+            if stop.is_set():
+                return None
+            proc = subprocess.Popen(
+                runner.shell_executable + runner.shell_args,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                env=runner.modified_env,
+                start_new_session=True,
+            )
+            procs.append(proc)
+        return(proc.wait())
+
+    with ThreadPoolExecutor(max_workers=min(threads, len(probes))) as pool:
+        pending = {pool.submit(probe, call): dep for dep, call in probes.items()}
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dep = pending.pop(future)
+                    if future.result() in (0, 1):
+                        results[dep] = "Installed"
+                    else:
+                        results[dep] = "Missing"
+                        return dep
+        finally:
+            with lock:
+                stop.set()
+                for proc in procs:
+                    kill_probe(proc)
+            for future in pending:
+                future.cancel()
+    return None
+
+def check_fail_fast(std_deps: list, pip_deps: list, r_deps: list, libs: bool = False) -> tuple:
+    '''
+    Test deps, stopping at the first missing one.
+    Cheapest checks run first: pip metadata lookups, then a PATH lookup for
+    every tool. Tool commands are then run concurrently (see run_probes), or
+    with libs their shared libraries are checked instead (see check_libs).
+    R packages are checked last.
+
+    Returns the exe, pip and rlang status dicts plus the first missing dep (or None).
+    Deps that were never checked are reported as Cancelled.
+    '''
+    import shutil
+    tested_exe = {dep: "Cancelled" for dep in std_deps}
+    tested_pips = {dep: "Cancelled" for dep in pip_deps}
+    tested_rlang = {dep: "Cancelled" for dep in r_deps}
+
+    for dep in pip_deps:
+        tested_pips[dep] = check_pip(dep)
+        if tested_pips[dep] == "Missing":
+            return(tested_exe, tested_pips, tested_rlang, dep)
+
+    probes = {}
+    for dep in std_deps:
+        call = tool_call(dep)
+        if call is None:
+            tested_exe[dep] = "Not tested"
+        elif shutil.which(call[0]) is None:
+            tested_exe[dep] = "Missing"
+            return(tested_exe, tested_pips, tested_rlang, dep)
+        else:
+            probes[dep] = call
+
+    if libs:
+        for dep in probes:
+            tested_exe[dep] = check_libs(dep)
+            if is_failed(tested_exe[dep]):
+                return(tested_exe, tested_pips, tested_rlang, dep)
+        probes = {}
+
+    missing = run_probes(probes, tested_exe)
+    if missing:
+        return(tested_exe, tested_pips, tested_rlang, missing)
+
+    if r_deps:
+        for status, dep in zip(check_r(r_deps), r_deps):
+            tested_rlang[dep] = status
+            if status == "Missing" and not missing:
+                missing = dep
+
+    return(tested_exe, tested_pips, tested_rlang, missing)
+
+def is_failed(status: str) -> bool:
+    """
+    Missing and Broken (missing libfoo.so) both count as failed
+    """
+    return(status == "Missing" or status.startswith("Broken"))
+
 def pretty_print(tested_tools: dict, type: str, pp: bool) -> None:
     """
     Pretty print to terminal the status of the tools 
@@ -525,15 +893,23 @@ def dumps(yaml: dict, indent="") -> str:
 
 def parse_yaml2(yaml: str) -> dict:
     try:
-        yamldict = load(yaml)
+        return(read_yaml_deps(yaml))
     except Exception as e:
         print(f"{colors.WARNING}There was an issue parsing the conda.yaml file. Error: {e}{colors.ENDC}")
         sys.exit()
 
+def read_yaml_deps(yaml: str) -> tuple:
+    '''
+    Parse a conda yaml into std, pip and R deps.
+    Unlike parse_yaml2, errors are raised rather than exiting.
+    '''
+    yamldict = load(yaml)
+
     # get pip deps
+    pip = None
     try:
         pip = yamldict['dependencies'].pop('pip')
-    except KeyError as e:
+    except KeyError:
         pass
 
     std_deps = []
@@ -565,6 +941,366 @@ def parse_yaml2(yaml: str) -> dict:
 
     return(std_deps, pip_deps, r_deps)
 
+#################
+### Snakemake ###
+#################
+
+class MissingDependencies(Exception):
+    pass
+
+def check_env(env) -> tuple:
+    '''
+    Check one environment: a conda yaml path or a list of tool names.
+    Returns the exe, pip and rlang status dicts.
+    Raises MissingDependencies if the yaml can't be read.
+    '''
+    if isinstance(env, (list, tuple)):
+        std_deps, pip_deps, r_deps = list(env), [], []
+    else:
+        try:
+            std_deps, pip_deps, r_deps = read_yaml_deps(env)
+        except Exception as e:
+            raise MissingDependencies(f"Could not read env {env}: {e}") from e
+
+    tested_exe = {dep: check_exe(dep) for dep in std_deps}
+    tested_pips = {dep: check_pip(dep) for dep in pip_deps}
+    tested_rlang = dict(zip(r_deps, check_r(r_deps))) if r_deps else {}
+    return(tested_exe, tested_pips, tested_rlang)
+
+def rule_name(job) -> str:
+    """
+    Name of a rule given a name, a snakemake rule or a snakemake job
+    """
+    if isinstance(job, str):
+        return(job)
+    rule = getattr(job, "rule", job)
+    return(rule.name)
+
+def rules_from_dag(dot: str) -> list:
+    '''
+    Rule names from `snakemake --dag` (or --rulegraph) dot output, in order of appearance.
+    Jobs that don't need to run (drawn dashed) are skipped, like "no update" in rules_from_summary.
+    '''
+    import re
+    rules = []
+    # attribute list of each statement eg [label = "map", style="rounded,dashed"]
+    for attributes in re.findall(r'\[((?:[^\]"]|"[^"]*")*)\]', dot):
+        attrs = {key: quoted or bare for key, quoted, bare
+                 in re.findall(r'(\w+)\s*=\s*(?:"([^"]*)"|([^,\s]+))', attributes)}
+        if "label" not in attrs or "dashed" in attrs.get("style", ""):
+            continue
+        # job labels are "rule\\nwildcard: value"
+        name = attrs["label"].split("\\n")[0].strip()
+        if name and name not in rules:
+            rules.append(name)
+    return(rules)
+
+def rules_from_summary(summary: str) -> list:
+    '''
+    Rule names from `snakemake --summary` output that still need to run.
+    '''
+    rules = []
+    lines = summary.strip().split("\n")
+    if not lines or not lines[0].startswith("output_file"):
+        return(rules)
+    header = lines[0].split("\t")
+    for line in lines[1:]:
+        row = dict(zip(header, line.split("\t")))
+        name = row.get("rule", "-")
+        if name != "-" and row.get("plan") != "no update" and name not in rules:
+            rules.append(name)
+    return(rules)
+
+class RuleChecker:
+    '''
+    Lazily check the environments used by snakemake rules.
+
+    rule_envs maps rule name to a conda yaml path or a list of tools.
+    Each environment is checked once, on first use, and memoized for the
+    life of the process - rules sharing an env share the check.
+    prefetch starts checks in the background so they overlap with running jobs.
+
+    checker = RuleChecker.from_workflow(workflow)
+    checker.prefetch(rules_from_dag(dot))
+    checker.require("map_reads")
+    '''
+    def __init__(self, rule_envs: dict, threads: int = 4):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        self.rule_envs = rule_envs
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.lock = threading.Lock()
+        self.checks = {}
+
+    @classmethod
+    def from_workflow(cls, workflow, **kwargs):
+        """
+        Build from a snakemake workflow, using the conda directive of each rule.
+        Only yaml files are used - named envs, callables and urls are skipped.
+        Relative paths are resolved against the rule's Snakefile.
+        Call once all rules are defined eg at the end of the Snakefile.
+        """
+        rule_envs = {}
+        for rule in workflow.rules:
+            env = getattr(rule, "conda_env", None)
+            if not env or callable(env):
+                continue
+            env = str(getattr(env, "file", env))
+            if "://" in env or not env.endswith((".yaml", ".yml")):
+                continue
+            snakefile = getattr(rule, "snakefile", None)
+            basedir = os.path.dirname(str(snakefile)) if snakefile else getattr(workflow, "basedir", "")
+            rule_envs[rule.name] = os.path.join(str(basedir), env)
+        return(cls(rule_envs, **kwargs))
+
+    def submit(self, job):
+        '''
+        Start checking the env of a rule (or job) in the background if not already started.
+        Returns the future, or None if the rule has no env.
+        '''
+        env = self.rule_envs.get(rule_name(job))
+        if not env:
+            return None
+        key = tuple(env) if isinstance(env, (list, tuple)) else str(env)
+        with self.lock:
+            if key not in self.checks:
+                self.checks[key] = self.pool.submit(check_env, env)
+            return(self.checks[key])
+
+    def prefetch(self, jobs: list) -> None:
+        """
+        Start background checks for the envs of the scheduled jobs or rules
+        """
+        for job in jobs:
+            self.submit(job)
+
+    def check(self, job) -> tuple:
+        '''
+        Results for the env of a rule (or job), blocking until its check is done.
+        Returns the exe, pip and rlang status dicts.
+        '''
+        future = self.submit(job)
+        if future is None:
+            return({}, {}, {})
+        return(future.result())
+
+    def missing(self, job) -> list:
+        """
+        Failed deps for the env of a rule (or job)
+        """
+        return([dep for tested in self.check(job) for dep, status in tested.items() if is_failed(status)])
+
+    def require(self, job) -> None:
+        """
+        Raise MissingDependencies if any dep of the rule's env is missing
+        """
+        missing = self.missing(job)
+        if missing:
+            raise MissingDependencies(f"Rule {rule_name(job)} is missing dependencies: {', '.join(missing)}")
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+#################
+### Aggregate ###
+#################
+
+result_suffixes = (".tsv", ".jsonl")
+
+def split_version(dep: str) -> tuple:
+    """
+    Split a dep spec into name and version eg python=3.9 -> (python, 3.9)
+    """
+    name, _, version = dep.partition("=")
+    return(name, version.lstrip("="))
+
+def read_results(job: tuple) -> tuple:
+    '''
+    Parse one depme results file: tsv as made by write_results or JSON Lines
+    with dep, status and optional version/node/env keys.
+    job is (filename, node, env) - used unless a record sets its own.
+
+    Returns (filename, records, error) where records is a list of
+    (node, env, dep, cell) and cell is the status plus version.
+    A file that can't be read or parsed has no records and the error message.
+    '''
+    import json
+    filename, node, env = job
+    records = []
+    try:
+        with open(filename, "r") as file:
+            if filename.endswith(".jsonl"):
+                for line in file:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    dep, version = split_version(record["dep"])
+                    version = record.get("version") or version
+                    records.append((record.get("node") or node, record.get("env") or env,
+                                    dep, record["status"], version))
+            else:
+                for number, line in enumerate(file, 1):
+                    if not line.strip():
+                        continue
+                    # write_results rows are exactly dep<TAB>status, anything else
+                    # (a dep list, an aggregate table) is not a results file
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != 2 or not fields[0]:
+                        raise ValueError(f"line {number} is not dep<TAB>status")
+                    dep, status = fields
+                    dep, version = split_version(dep)
+                    records.append((node, env, dep, status, version))
+    except (OSError, UnicodeDecodeError, ValueError, KeyError, TypeError, AttributeError) as e:
+        return(filename, [], f"{type(e).__name__}: {e}")
+    return(filename,
+           [(node, env, dep, f"{status} ({version})" if version else status)
+            for node, env, dep, status, version in records],
+           None)
+
+def read_results_chunk(jobs: list) -> list:
+    return([read_results(job) for job in jobs])
+
+def walk_results(path: str):
+    """
+    Yield results files under path in sorted order
+    """
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            if name.endswith(result_suffixes):
+                yield os.path.join(root, name)
+
+def find_results(paths: list, node_from: str = "path"):
+    '''
+    Yield (filename, node, env) for every results file. Directories are walked
+    recursively for files ending in .tsv or .jsonl.
+    With node_from path or parent the node is the directory of the file (full path
+    or name) and the env is the file stem eg results/node1/env1.tsv. With stem the
+    file stem is the node and there is a single env.
+    '''
+    from pathlib import Path
+    for path in paths:
+        path = str(path)
+        for filename in walk_results(path) if os.path.isdir(path) else [path]:
+            if node_from == "stem":
+                yield (filename, Path(filename).stem, "")
+            elif node_from == "parent":
+                yield (filename, Path(filename).parent.name, Path(filename).stem)
+            else:
+                yield (filename, str(Path(filename).parent), Path(filename).stem)
+
+def chunked(iterable, size: int):
+    from itertools import islice
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+class FleetTable:
+    '''
+    Compact (node, env) x dependency status table.
+    Node, env, dep and cell strings are stored once; each row is an array of
+    cell indexes (0 is NA, the dep was not reported for that node and env).
+    '''
+    def __init__(self):
+        self.nodes = {}
+        self.deps = {}
+        self.cells = {"NA": 0}
+        self.rows = []
+        self.bad_files = []
+
+    def add(self, node: str, env: str, dep: str, cell: str) -> None:
+        if (node, env) not in self.nodes:
+            from array import array
+            self.nodes[(node, env)] = len(self.rows)
+            self.rows.append(array("I"))
+        row = self.rows[self.nodes[(node, env)]]
+        col = self.deps.setdefault(dep, len(self.deps))
+        code = self.cells.setdefault(cell, len(self.cells))
+        if col >= len(row):
+            row.extend([0] * (col + 1 - len(row)))
+        row[col] = code
+
+    def merge(self, results: list) -> None:
+        """
+        Add the output of read_results_chunk, keeping track of bad files
+        """
+        for filename, records, error in results:
+            if error:
+                self.bad_files.append((filename, error))
+            for record in records:
+                self.add(*record)
+
+    def drift(self) -> dict:
+        '''
+        Deps where status or version differs across nodes using the same env.
+        NA (dep not reported) is not compared - only reported values count.
+        Returns {(env, dep): Counter of cell -> number of nodes}
+        '''
+        from collections import Counter
+        cell_names = list(self.cells)
+        dep_names = list(self.deps)
+        counts = defaultdict(Counter)
+        for (node, env), index in self.nodes.items():
+            for col, code in enumerate(self.rows[index]):
+                if code:
+                    counts[(env, dep_names[col])][code] += 1
+        return({key: Counter({cell_names[code]: n for code, n in codes.items()})
+                for key, codes in counts.items() if len(codes) > 1})
+
+    def write(self, filename: Path) -> None:
+        '''
+        Write table as tsv, one row per node and env and one column per dep
+        '''
+        cell_names = list(self.cells)
+        with open(filename, "w") as outfile:
+            outfile.write("\t".join(["node", "env", *self.deps]) + "\n")
+            for (node, env), index in self.nodes.items():
+                row = self.rows[index]
+                cells = [cell_names[row[col]] if col < len(row) else "NA" for col in range(len(self.deps))]
+                outfile.write("\t".join([node, env, *cells]) + "\n")
+
+def aggregate_results(paths: list, node_from: str = "path", jobs: int = 1, chunksize: int = 64) -> FleetTable:
+    '''
+    Stream merge depme results files into a FleetTable.
+    Files are read in chunks of chunksize by jobs worker processes, with at most
+    two chunks per worker in flight, and merged in order as they arrive.
+    Only the compact table is kept in memory. Small inputs are read in process.
+    '''
+    from collections import deque
+    from itertools import chain
+    from multiprocessing import Pool
+
+    table = FleetTable()
+    chunks = chunked(find_results(paths, node_from), chunksize)
+    head = [chunk for chunk in (next(chunks, None), next(chunks, None)) if chunk]
+
+    if jobs <= 1 or len(head) < 2:
+        for chunk in chain(head, chunks):
+            table.merge(read_results_chunk(chunk))
+        return(table)
+
+    with Pool(jobs) as pool:
+        in_flight = deque()
+        for chunk in chain(head, chunks):
+            in_flight.append(pool.apply_async(read_results_chunk, (chunk,)))
+            if len(in_flight) >= 2 * jobs:
+                table.merge(in_flight.popleft().get())
+        while in_flight:
+            table.merge(in_flight.popleft().get())
+    return(table)
+
+def write_drift(filename: Path, drifted: dict) -> None:
+    '''
+    Write drifted deps as tsv: env, dep, number of distinct values, value:count pairs
+    '''
+    with open(filename, "w") as outfile:
+        for (env, dep), counts in drifted.items():
+            values = "; ".join(f"{cell}:{n}" for cell, n in counts.most_common())
+            outfile.write(f"{env}\t{dep}\t{len(counts)}\t{values}\n")
+
 ############
 ### Main ###
 ############
@@ -578,28 +1314,32 @@ def run(args):
     from argparse import Namespace
     depme.run(Namespace(ArgsGoHere))
     """
-    
+    if getattr(args, "fail_fast", False):
+        return run_fail_fast(args)
+
+    check = check_libs if getattr(args, "libs", False) else check_exe
+
     tested_exe = defaultdict(dict)
     tested_pips = defaultdict(dict)
     tested_rlang = defaultdict(dict)
 
     if args.input:
         for dep in args.input:
-            tested_exe[dep] = check_exe(dep)
+            tested_exe[dep] = check(dep)
         pretty_print(tested_exe, type="Conda", pp=args.pretty_print)
 
     if args.file:
         # only std_deps are supported here
         std_deps, pip_deps = parse_file(args.file)
         for dep in std_deps:
-            tested_exe[dep] = check_exe(dep)
+            tested_exe[dep] = check(dep)
         pretty_print(tested_exe, type="Conda", pp=args.pretty_print)
 
     if args.yaml:
         std_deps, pip_deps, r_deps = parse_yaml2(args.yaml)
         if std_deps:
             for dep in std_deps:
-                tested_exe[dep] = check_exe(dep)
+                tested_exe[dep] = check(dep)
             pretty_print(tested_exe, type="Conda", pp=args.pretty_print)
         if pip_deps:
             for dep in pip_deps:
@@ -615,7 +1355,7 @@ def run(args):
     if args.output:
         write_results(args.output, tested_exe, tested_pips, tested_rlang)
 
-    if "Missing" in list(tested_exe.values()) + list(tested_rlang.values()) + list(tested_pips.values()):
+    if any(is_failed(status) for status in list(tested_exe.values()) + list(tested_rlang.values()) + list(tested_pips.values())):
         print(f"\n{colors.WARNING}Testing complete - Missing dependencies detected.{colors.ENDC}")
         if args.error:
             sys.exit(1)
@@ -624,7 +1364,70 @@ def run(args):
     else:
         print(f"\n{colors.OKCYAN}Testing complete.{colors.ENDC}")
 
-usage=f"""depme [-h] [-f FILE] [-y YAML] [-o OUTPUT] [-p] [-e] [input ...]
+def run_fail_fast(args):
+    """
+    Fail-fast variant of run: stop at the first missing dependency and
+    exit with status code 1. Outstanding checks are cancelled.
+    """
+    std_deps = []
+    pip_deps = []
+    r_deps = []
+
+    if args.input:
+        std_deps.extend(args.input)
+    if args.file:
+        std_deps.extend(parse_file(args.file)[0])
+    if args.yaml:
+        yaml_std, pip_deps, r_deps = parse_yaml2(args.yaml)
+        std_deps.extend(yaml_std)
+
+    libs = getattr(args, "libs", False)
+    tested_exe, tested_pips, tested_rlang, missing = check_fail_fast(std_deps, pip_deps, r_deps, libs=libs)
+
+    for tested, type in [(tested_exe, "Conda"), (tested_pips, "Pip"), (tested_rlang, "Rlang")]:
+        if tested:
+            pretty_print(tested, type=type, pp=args.pretty_print)
+
+    if args.output:
+        write_results(args.output, tested_exe, tested_pips, tested_rlang)
+
+    if missing:
+        print(f"\n{colors.WARNING}Testing stopped - Missing dependency detected: {missing}{colors.ENDC}")
+        sys.exit(1)
+    else:
+        print(f"\n{colors.OKCYAN}Testing complete.{colors.ENDC}")
+
+def aggregate(args):
+    """
+    Merge results files from many nodes and report drift.
+    """
+    table = aggregate_results(args.results, node_from=args.node, jobs=args.jobs)
+    drifted = table.drift()
+
+    if args.output:
+        table.write(args.output)
+    if args.drift:
+        write_drift(args.drift, drifted)
+
+    for filename, error in table.bad_files:
+        print(f"{colors.WARNING}Skipped unreadable results file {filename} - {error}{colors.ENDC}", file=sys.stderr)
+
+    nodes = {node for node, env in table.nodes}
+    envs = {env for node, env in table.nodes}
+    print(f"{colors.UNDERLINE}Aggregated {len(nodes)} nodes, {len(envs)} envs, {len(table.deps)} dependencies{colors.ENDC}")
+    for (env, dep), counts in drifted.items():
+        name = f"{env}/{dep}" if env else dep
+        values = ", ".join(f"{cell} x{n}" for cell, n in counts.most_common())
+        print(f"{colors.WARNING:10s}{name:10s} \t{values}{colors.ENDC}", file=sys.stdout)
+
+    if drifted:
+        print(f"\n{colors.WARNING}Aggregation complete - Drift detected in {len(drifted)} dependencies.{colors.ENDC}")
+        if args.error:
+            sys.exit(1)
+    else:
+        print(f"\n{colors.OKCYAN}Aggregation complete - No drift.{colors.ENDC}")
+
+usage=f"""depme [-h] [-f FILE] [-y YAML] [-o OUTPUT] [-p] [-e] [-x] [-l] [--self-timing] [input ...]
 
 Examples:\n
     Terminal:\t depme snakemake nextflow mafft
@@ -633,9 +1436,73 @@ Examples:\n
     \t Add -o depsme.tsv to save output
     \t Add -p to print to terminal
     \t Use -e to disable returning exit status code 1 if any tool is missing 
+    \t Use -x to stop at the first missing tool
+    \t Use -l to check shared libraries instead of running tools
+    Aggregate:\t depme aggregate -o fleet.tsv -d drift.tsv results/
 """
 
-def main():
+def main_aggregate(argv: list):
+    import argparse
+    from pathlib import Path
+
+    parser = argparse.ArgumentParser(
+        description="Merge depme results files (tsv or .jsonl) and report drift across nodes.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog="depme aggregate")
+
+    parser.add_argument("results", nargs="+",
+                        help="Results files or directories to search for .tsv/.jsonl")
+    parser.add_argument("-o", "--output", type=Path,
+                        help="Write node/env x dependency table to file - tsv with headers")
+    parser.add_argument("-d", "--drift", type=Path,
+                        help="Write drifted dependencies to file - tsv")
+    parser.add_argument("-n", "--node",
+                        choices=["path", "stem", "parent"],
+                        default="path",
+                        help="Node is the directory of each results file (full path or name) and env the file stem, or with stem the file stem is the node")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=min(4, os.cpu_count() or 1),
+                        help="Number of parallel reader processes")
+    parser.add_argument("-e", "--error",
+                        action="store_true",
+                        default=False,
+                        help="Return error code if any drift is detected.")
+    args = parser.parse_args(argv)
+    aggregate(args)
+
+# flags accepted by the fast path, see parse_fast
+fast_flags = {
+    "-p": "pretty_print", "--pretty-print": "pretty_print",
+    "-e": "error", "--error": "error",
+    "-x": "fail_fast", "--fail-fast": "fail_fast",
+    "-l": "libs", "--libs": "libs",
+    "--self-timing": "self_timing",
+}
+
+def parse_fast(argv: list):
+    '''
+    Fast path for the common case of tool names plus simple flags
+    eg depme -p snakemake mafft. Avoids importing argparse.
+
+    Returns the args or None if argv needs the full parser.
+    '''
+    from types import SimpleNamespace
+
+    args = SimpleNamespace(input=[], file=None, yaml=None, output=None,
+                           **{flag: False for flag in fast_flags.values()})
+    for arg in argv:
+        if arg in fast_flags:
+            setattr(args, fast_flags[arg], True)
+        elif arg.startswith("-"):
+            return None
+        else:
+            args.input.append(arg)
+    return(args if args.input else None)
+
+def parse_args(argv: list):
+    import argparse
+    from pathlib import Path
+
     parser = argparse.ArgumentParser(
         description="Test workflow dependencies. Enter the name of the tool",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -658,8 +1525,43 @@ def main():
                         action="store_true",
                         default=False,
                         help="Return error code if any dependency is missing.")
-    args = parser.parse_args(args=None if sys.argv[1:] else ["--help"])
-    
+    parser.add_argument("-x", "--fail-fast",
+                        action="store_true",
+                        default=False,
+                        help="Stop at the first missing dependency and return error code.")
+    parser.add_argument("-l", "--libs",
+                        action="store_true",
+                        default=False,
+                        help="Check that shared libraries of each tool resolve instead of running it.")
+    parser.add_argument("--self-timing",
+                        action="store_true",
+                        default=False,
+                        help="Report time spent importing, parsing arguments and checking to stderr.")
+    return(parser.parse_args(args=argv if argv else ["--help"]))
+
+def print_timings() -> None:
+    """
+    Print time spent in each phase to stderr, see --self-timing.
+    Interpreter startup is not included.
+    """
+    timings["end"] = time.perf_counter()
+    phases = {
+        "import": timings["import"] - timings["start"],
+        "parse": timings["probe"] - timings["parse"],
+        "probe": timings["end"] - timings["probe"],
+        "total": timings["end"] - timings["start"],
+    }
+    report = ", ".join(f"{phase} {seconds * 1000:.1f}" for phase, seconds in phases.items())
+    print(f"depme timing (ms): {report}", file=sys.stderr)
+
+def main():
+    argv = sys.argv[1:]
+    if argv[:1] == ["aggregate"]:
+        return main_aggregate(argv[1:])
+
+    timings["parse"] = time.perf_counter()
+    args = parse_fast(argv) or parse_args(argv)
+
     # check if both positional and file inputs are provided 
     if args.input and args.yaml:
         print(usage)
@@ -681,7 +1583,15 @@ def main():
         if not args.yaml.is_file():
             print(f"{colors.WARNING}File not detected, check if it exists: {args.file}{colors.ENDC}")
             sys.exit()
-    run(args)
+
+    timings["probe"] = time.perf_counter()
+    try:
+        run(args)
+    finally:
+        if args.self_timing:
+            print_timings()
+
+timings["import"] = time.perf_counter()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -63,4 +63,282 @@ def test_api():
     run(args)
     assert False
   except SystemExit:
-    assert True
\ No newline at end of file
+    assert True
+
+def test_fail_fast_path_lookup():
+  '''
+  a tool missing from PATH should stop checks before any command is run
+  '''
+  exe, pips, rlang, missing = check_fail_fast(['which', 'nextflow'], ['collections'], [])
+  assert missing == 'nextflow'
+  assert exe == {'which': 'Cancelled', 'nextflow': 'Missing'}
+  assert pips == {'collections': 'Installed'}
+
+def test_fail_fast_kills_probes(monkeypatch):
+  '''
+  a failing probe should kill slower probes still running
+  '''
+  import time
+  monkeypatch.setitem(tools_lib, 'slow', ['sleep', '30'])
+  monkeypatch.setitem(tools_lib, 'broken', ['bash', '-c', "'exit 2'"])
+
+  start = time.monotonic()
+  exe, pips, rlang, missing = check_fail_fast(['slow', 'broken'], [], [])
+  assert time.monotonic() - start < 10
+  assert missing == 'broken'
+  assert exe == {'slow': 'Cancelled', 'broken': 'Missing'}
+
+def test_fail_fast_bounded(monkeypatch):
+  '''
+  probes beyond the thread limit are queued and never started after a failure
+  '''
+  monkeypatch.setitem(tools_lib, 'broken', ['bash', '-c', "'exit 2'"])
+  monkeypatch.setitem(tools_lib, 'slow', ['sleep', '30'])
+  results = {'broken': 'Cancelled', 'slow': 'Cancelled'}
+  missing = run_probes({'broken': tools_lib['broken'], 'slow': tools_lib['slow']}, results, threads=1)
+  assert missing == 'broken'
+  assert results == {'broken': 'Missing', 'slow': 'Cancelled'}
+
+def test_aggregate(tmp_path):
+  '''
+  merge tsv and jsonl results and detect drift across nodes
+  '''
+  (tmp_path / "node1.tsv").write_text("python=3.9\tInstalled\nmafft\tInstalled\n")
+  (tmp_path / "node2.tsv").write_text("python=3.10\tInstalled\nmafft\tInstalled\n")
+  (tmp_path / "node3.jsonl").write_text('{"dep": "mafft", "status": "Missing"}\n')
+
+  table = aggregate_results([tmp_path], node_from="stem")
+  assert list(table.nodes) == [('node1', ''), ('node2', ''), ('node3', '')]
+  assert list(table.deps) == ['python', 'mafft']
+
+  drifted = table.drift()
+  assert drifted[('', 'python')] == {'Installed (3.9)': 1, 'Installed (3.10)': 1}
+  assert drifted[('', 'mafft')] == {'Installed': 2, 'Missing': 1}
+
+  table.write(tmp_path / "fleet.out")
+  assert (tmp_path / "fleet.out").read_text().splitlines() == [
+    "node\tenv\tpython\tmafft",
+    "node1\t\tInstalled (3.9)\tInstalled",
+    "node2\t\tInstalled (3.10)\tInstalled",
+    "node3\t\tNA\tMissing",
+  ]
+
+def test_aggregate_envs(tmp_path):
+  '''
+  envs are compared across nodes, not against each other
+  '''
+  for node in ['node1', 'node2']:
+    (tmp_path / node).mkdir()
+    (tmp_path / node / "env1.tsv").write_text("mafft\tInstalled\n")
+    (tmp_path / node / "env2.tsv").write_text(f"mafft\t{'Missing' if node == 'node2' else 'Installed'}\nseqkit\tInstalled\n")
+
+  table = aggregate_results([tmp_path], node_from="parent")
+  assert list(table.nodes) == [('node1', 'env1'), ('node1', 'env2'), ('node2', 'env1'), ('node2', 'env2')]
+  assert table.drift() == {('env2', 'mafft'): {'Installed': 1, 'Missing': 1}}
+
+def test_aggregate_bad_files(tmp_path):
+  '''
+  anything but dep<TAB>status rows, eg dep lists or earlier aggregate output,
+  makes a file bad - bad files are skipped and reported
+  '''
+  (tmp_path / "node1.tsv").write_text("snakemake\tInstalled\n")
+  (tmp_path / "deps.txt").write_text("snakemake\n")
+  (tmp_path / "node2.tsv").write_text("snakemake\n")
+  (tmp_path / "node3.jsonl").write_text('{"dep": "snakemake", "status": "Installed"}\n{not json\n')
+  (tmp_path / "node4.jsonl").write_text('{"status": "Installed"}\n')
+
+  first = aggregate_results([tmp_path], node_from="stem")
+  first.write(tmp_path / "fleet.tsv")
+  from collections import Counter
+  write_drift(tmp_path / "drift.tsv", {('', 'snakemake'): Counter({'Installed': 1, 'Missing': 1})})
+
+  table = aggregate_results([tmp_path], node_from="stem")
+  assert list(table.nodes) == [('node1', '')]
+  assert list(table.deps) == ['snakemake']
+  assert table.drift() == {}
+  assert [filename for filename, error in table.bad_files] == [
+    str(tmp_path / name) for name in ['drift.tsv', 'fleet.tsv', 'node2.tsv', 'node3.jsonl', 'node4.jsonl']]
+
+def test_aggregate_parallel(tmp_path):
+  '''
+  parallel readers give the same table as a single reader
+  '''
+  for i in range(200):
+    (tmp_path / f"node{i}.tsv").write_text(f"snakemake\tInstalled\nseqkit\t{'Missing' if i % 7 else 'Installed'}\n")
+
+  serial = aggregate_results([tmp_path], node_from="stem")
+  parallel = aggregate_results([tmp_path], node_from="stem", jobs=4, chunksize=8)
+  assert serial.nodes == parallel.nodes
+  assert serial.drift() == parallel.drift()
+  assert list(parallel.drift()) == [('', 'seqkit')]
+
+def test_read_ld_cache():
+  '''
+  the ld.so cache should resolve libc
+  '''
+  import os, pytest
+  if not os.path.exists('/etc/ld.so.cache'):
+    pytest.skip('no ld.so cache')
+  assert read_ld_cache()['libc.so.6']
+
+def test_check_libs(tmp_path, monkeypatch):
+  '''
+  a binary with a DT_NEEDED library that can't be resolved is Broken
+  '''
+  import os, shutil
+  bash = os.path.realpath(shutil.which('bash'))
+  needed = read_elf(bash)['needed']
+  assert needed
+  assert missing_libs(bash) == []
+
+  # rename the first needed library inside a copy of bash
+  data = open(bash, 'rb').read()
+  fake = 'x' * (len(needed[0]) - 3) + '.so'
+  broken = tmp_path / 'bash'
+  broken.write_bytes(data.replace(needed[0].encode() + b'\0', fake.encode() + b'\0', 1))
+  broken.chmod(0o755)
+
+  monkeypatch.setenv('PATH', str(tmp_path), prepend=os.pathsep)
+  monkeypatch.setitem(tools_lib, 'bash', ['bash', '--version'])
+  assert check_libs('bash') == f"Broken (missing {fake})"
+  assert check_libs('thisprogramshouldntexist') == "Not tested"
+
+  # scripts whose interpreter is gone after an env update
+  script = tmp_path / 'tool.sh'
+  monkeypatch.setitem(tools_lib, 'tool', ['tool.sh'])
+  script.write_text(f"#!{tmp_path / 'gone' / 'python'}\n")
+  script.chmod(0o755)
+  assert check_libs('tool') == f"Broken (missing interpreter {tmp_path / 'gone' / 'python'})"
+  script.write_text("#!/usr/bin/env thisinterpretershouldntexist\n")
+  assert check_libs('tool') == "Broken (missing interpreter thisinterpretershouldntexist)"
+  assert check_libs('tool=1.0') == "Broken (missing interpreter thisinterpretershouldntexist)"
+
+  # a half written copy of bash
+  broken.write_bytes(data[:200])
+  assert check_libs('bash').startswith("Broken (unreadable ELF")
+
+def test_rules_from_dag():
+  dot = '''digraph snakemake_dag {
+    graph[bgcolor=white, margin=0];
+    node[shape=box, style=rounded, fontname=sans, fontsize=10, penwidth=2];
+    0[label = "all", color = "0.0 0.6 0.85", style="rounded"];
+    1[label = "map\\nsample: A", color = "0.33 0.6 0.85", style="rounded"];
+    2[label = "map\\nsample: B", color = "0.33 0.6 0.85", style="rounded,dashed"];
+    3[label = "trim\\nsample: B", color = "0.66 0.6 0.85", style="rounded,dashed"];
+    1 -> 0
+    2 -> 0
+    3 -> 2
+  }'''
+  assert rules_from_dag(dot) == ['all', 'map']
+
+def test_rules_from_summary():
+  summary = ("output_file\tdate\trule\tversion\tlog-file(s)\tstatus\tplan\n"
+             "a.bam\t-\tmap\t-\t\tmissing\tupdate pending\n"
+             "a.vcf\tMon\tcall\t-\t\tok\tno update\n")
+  assert rules_from_summary(summary) == ['map']
+
+def test_rule_checker(monkeypatch):
+  '''
+  envs are checked only for the rules used, once per env
+  '''
+  import depme.main
+  calls = []
+  def fake_check_env(env):
+    calls.append(env)
+    return check_env(env)
+  monkeypatch.setattr(depme.main, 'check_env', fake_check_env)
+
+  checker = RuleChecker({
+    'map': ['which'],
+    'map_again': ['which'],
+    'call': ['which', 'nextflow'],
+    'plot': 'does/not/exist.yaml',
+  })
+  checker.prefetch(['map', 'map_again'])
+  assert checker.check('map') == ({'which': 'Installed'}, {}, {})
+  checker.require('map_again')
+  assert checker.missing('call') == ['nextflow']
+  assert checker.check('all') == ({}, {}, {})
+  try:
+    checker.require('call')
+    assert False
+  except MissingDependencies:
+    pass
+  try:
+    checker.check('plot')
+    assert False
+  except MissingDependencies:
+    pass
+  checker.shutdown()
+  assert calls == [['which'], ['which', 'nextflow'], 'does/not/exist.yaml']
+
+def test_rule_checker_workflow(tmp_path):
+  '''
+  only yaml envs are taken from a workflow, relative to the Snakefile
+  '''
+  from types import SimpleNamespace
+  (tmp_path / "envs").mkdir()
+  (tmp_path / "envs" / "map.yaml").write_text("name: map\ndependencies:\n  - which\n")
+  snakefile = str(tmp_path / "Snakefile")
+  workflow = SimpleNamespace(basedir=str(tmp_path), rules=[
+    SimpleNamespace(name='map', conda_env='envs/map.yaml', snakefile=snakefile),
+    SimpleNamespace(name='named', conda_env='myenv', snakefile=snakefile),
+    SimpleNamespace(name='dynamic', conda_env=lambda wildcards: 'envs/map.yaml', snakefile=snakefile),
+    SimpleNamespace(name='all', conda_env=None, snakefile=snakefile),
+  ])
+
+  checker = RuleChecker.from_workflow(workflow)
+  assert checker.rule_envs == {'map': str(tmp_path / "envs" / "map.yaml")}
+  assert checker.check('map') == ({'which': 'Installed'}, {}, {})
+  assert checker.check('named') == ({}, {}, {})
+  checker.shutdown()
+
+# seconds allowed on top of a bare interpreter for importing depme and parsing
+# arguments on the fast path
+startup_budget = 0.025
+
+def test_lazy_imports():
+  '''
+  importing depme should not pull in the heavy modules
+  '''
+  import subprocess, sys
+  code = "import sys; before = set(sys.modules); import depme.main; print(' '.join(set(sys.modules) - before))"
+  loaded = subprocess.check_output([sys.executable, "-c", code]).decode().split()
+  for module in ['argparse', 'subprocess', 'pathlib', 'json', 'concurrent.futures', 'multiprocessing', 'threading']:
+    assert module not in loaded
+
+def test_parse_fast():
+  args = parse_fast(['-p', '-x', 'snakemake', 'mafft'])
+  assert args.input == ['snakemake', 'mafft']
+  assert args.pretty_print and args.fail_fast and not args.error
+  assert parse_fast(['-o', 'out.tsv', 'mafft']) is None
+  assert parse_fast(['-p']) is None
+
+def test_self_timing():
+  import subprocess, sys
+  out = subprocess.run([sys.executable, "-m", "depme.main", "--self-timing", "which"],
+                       capture_output=True, check=True).stderr.decode()
+  report = out.strip().split("depme timing (ms): ")[-1]
+  phases = {phase: float(ms) for phase, ms in (item.split() for item in report.split(", "))}
+  assert set(phases) == {'import', 'parse', 'probe', 'total'}
+
+def test_startup_budget(tmp_path):
+  '''
+  cold start (interpreter + import + argument parsing) stays within startup_budget
+  of a bare interpreter. Byte code is cached in tmp_path as it would be once installed.
+  '''
+  import os, subprocess, sys, time
+  env = {**os.environ, "PYTHONPYCACHEPREFIX": str(tmp_path)}
+  env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+  def wall(code):
+    times = []
+    for _ in range(7):
+      start = time.perf_counter()
+      subprocess.run([sys.executable, "-c", code], check=True, env=env)
+      times.append(time.perf_counter() - start)
+    return min(times)
+
+  baseline = wall("pass")
+  depme = wall("import depme.main; depme.main.parse_fast(['-p', 'snakemake'])")
+  assert depme - baseline < startup_budget